@@ -4,12 +4,17 @@
 import numpy as np
 import joblib
 import os
+import types
+
+# below this many values (pop_size * n_params) joblib overhead outweighs a parallel predict
+PARALLEL_PREDICT_THRESHOLD = 10000
+
 
 class GeneticAlgorithm:
 
-    def __init__(self, model, parameters, boundaries, X_scale=None, y_scale=None, pop_size=10, precision=5):
+    def __init__(self, model, parameters, boundaries, X_scale=None, y_scale=None, pop_size=10, precision=5, seed=None, batch_model=None):
         '''
-        model - model to evalute fitness (may need to adjust _model_fitness() to work w different models);
+        model - model to evalute fitness (may need to adjust _model_batch() to work w different models);
 
         parameters - list of parameters to optimize
 
@@ -22,12 +27,27 @@ class GeneticAlgorithm:
         pop_size - default=10, number of samples to keep in population at a time
 
         precision - degree of precision to round search
+
+        seed - default=None, seed for the random number generator (for reproducible runs)
+
+        batch_model - default=None, vectorized fitness function taking a (N, n_parameters) array
+        (columns in the order of parameters) and returning N fitness values. Takes priority over
+        model and skips the scalers; recommended for expensive user fitness functions
+        (model may be None when this is given)
         '''
 
         # set upon initialization of object
         self.model = model
         self.parameters = parameters
         self.boundaries = boundaries
+        self.batch_model = batch_model
+        # plain python fitness functions take a dictionary instead of a feature array
+        self._model_is_callable = isinstance(model, types.FunctionType)
+        self._param_idx = {parameter: idx for idx, parameter in enumerate(parameters)}
+        self._lows = np.array([b[0] for b in boundaries], dtype=float)
+        self._highs = np.array([b[1] for b in boundaries], dtype=float)
+        self._ranges = self._highs - self._lows
+        self._rng = np.random.default_rng(seed)
         self.population = self._initialize_pop(pop_size)
 
         # optional changes (scalers req if model data is scaled)
@@ -39,6 +59,16 @@ class GeneticAlgorithm:
         self._gen = None # save for export data
         self._exp = None
         self._precision = precision
+        self._elite_fits = None # fitness of the individuals carried over by the last _mating_pool
+
+        # working buffers reused every generation
+        self._fits = np.empty(pop_size) # fitness of the current population, row aligned
+        self._next_pop = np.empty_like(self.population) # swapped with population after each generation
+        self._sorted_pop = np.empty_like(self.population)
+        self._sorted_fits = np.empty(pop_size)
+        self._scratch = np.empty_like(self.population)
+        self._draws = np.empty(2*pop_size)
+        self._noise = np.empty_like(self.population)
 
     def _initialize_pop(self, size):
         '''
@@ -49,55 +79,102 @@ class GeneticAlgorithm:
             size - size of the population
 
         output:
-            list of dictionaries with sample parameter values
+            (size, n_parameters) array with sample parameter values, columns
+            follow the order of self.parameters
         '''
 
         if len(self.parameters) != len(self.boundaries):
             raise ValueError('Parameter list must match boundaries')
 
-        population = []
-        for _ in range(size):
-            individual = {}
-            for idx, parameter in enumerate(self.parameters):
-                individual[parameter] = np.random.uniform(low=self.boundaries[idx][0], high=self.boundaries[idx][1])
-            population.append(individual)
+        return self._lows + self._ranges * self._rng.random((size, len(self.parameters)))
 
-        return population
 
+    def _to_dict(self, individual):
+        '''
+        Converts a row of the population into a dictionary of {parameter : value}.
+        '''
+        return dict(zip(self._param_idx, individual.tolist()))
 
-    def _model_fitness(self, parameters):
+
+    def _batch_fitness(self, population, out=None):
         '''
-        Fitness function, sends in a feature set and returns a prediction at that point.
+        Vectorized fitness function, sends the whole (pop_size, n_features)
+        population to the model in a single call.
 
         input:
-            parameters - 1D dictionary of {parameter : value}
+            population - 2D array, one individual per row
+            out - optional 1D array to write the fitness into
 
         output:
-            prediction of the model given the feature set (scaler)
+            1D array of fitness values in the same order as the population
         '''
-        if callable(self.model) and (str(type(self.model)) == '<class \'function\'>'):
-            prediction = self.model(parameters)
-        else:
-            if self.X_scale and self.y_scale: 
-                parameters = self.X_scale.transform([list(parameters.values())])
-                prediction = self.y_scale.inverse_transform(self.model.predict(parameters))[0]
-            else:
-                vals = np.array(list(parameters.values()))
-                prediction = self.model.predict(vals.reshape(1,-1))
-
-        if type(prediction) is np.ndarray:
-            prediction = prediction[0]
-
-        if self.mode == 'minimize':
-            return prediction*-1
+        if self.batch_model is not None:
+            preds = np.ravel(self.batch_model(population))
         else:
-            return prediction
+            preds = self._model_batch(population)
+
+        return np.multiply(preds, self._sign, out=out)
+
+
+    def _update_fitness(self, n_new):
+        '''
+        Fills self._fits for the current population. Only the first n_new rows
+        (the children) are sent to the model, the elites carried over at the end of
+        the population keep the fitness computed for them in the previous generation.
+        '''
+        if n_new:
+            self._batch_fitness(self.population[:n_new], out=self._fits[:n_new])
+        if n_new < self.pop_size:
+            self._fits[n_new:] = self._elite_fits
+
+
+    def _model_batch(self, population):
+        '''
+        Raw model predictions (no minimize sign flip) for a 2D population array.
+        '''
+        if self._model_is_callable:
+            return np.array([np.ravel(self.model(self._to_dict(individual)))[0] for individual in population], dtype=float)
+
+        X = population
+        if self.X_scale and self.y_scale:
+            X = self.X_scale.transform(X)
+        preds = self._predict(X)
+        if self.X_scale and self.y_scale:
+            preds = self.y_scale.inverse_transform(np.reshape(preds, (-1,1)))
+        return np.ravel(preds)
+
+
+    def _predict(self, X):
+        '''
+        Calls model.predict on a 2D feature array. Large batches are split into
+        chunks predicted on threads when the model exposes n_jobs.
+        '''
+        n_jobs = joblib.effective_n_jobs(getattr(self.model, 'n_jobs', 1))
+        if X.size <= PARALLEL_PREDICT_THRESHOLD or n_jobs <= 1:
+            return self.model.predict(X)
+
+        chunks = joblib.Parallel(n_jobs=n_jobs, prefer='threads')(
+            joblib.delayed(self._predict_chunk)(chunk) for chunk in np.array_split(X, n_jobs)
+        )
+        return np.concatenate(chunks)
+
+
+    def _predict_chunk(self, X):
+        '''
+        model.predict for one chunk of a parallel predict. The model's own joblib
+        parallelism runs sequentially inside the worker thread, otherwise each chunk
+        would start another n_jobs threads (n_jobs**2 in total). The model's explicit
+        n_jobs overrides parallel_config(n_jobs=1), so the backend is switched instead.
+        Native threading (e.g. XGBoost's OpenMP) is not affected by this.
+        '''
+        with joblib.parallel_config(backend='sequential'):
+            return self.model.predict(X)
 
 
     def model_predict(self, parameters):
         '''
         Delivers a prediction from the model, doesn't worry about minimization or maximization
-        such as with model_fitness.
+        such as with _batch_fitness.
 
         input:
             parameters - 1D dictionary of {parameter : value}
@@ -105,32 +182,33 @@ class GeneticAlgorithm:
         output:
             prediction of the model given the feature set (scaler)
         '''
-        if callable(self.model) and (str(type(self.model)) == '<class \'function\'>'):
-            prediction = self.model(parameters)
-        else:
-            if self.X_scale and self.y_scale: 
-                parameters = self.X_scale.transform([list(parameters.values())])
-                prediction = self.y_scale.inverse_transform(self.model.predict(parameters))[0]
-            else:
-                vals = np.array(list(parameters.values()))
-                prediction = self.model.predict(vals.reshape(1,-1))
+        vals = np.fromiter(parameters.values(), dtype=float, count=len(self._param_idx)).reshape(1,-1)
+        if self.batch_model is not None:
+            return np.ravel(self.batch_model(vals))[0]
+        return self._model_batch(vals)[0]
 
-        if type(prediction) is np.ndarray:
-            prediction = prediction[0]
 
-        return prediction
+    def _sort_pop(self):
+        '''
+        Sorts the current population by the fitness computed for this generation.
+        Output arrays (population, fitness) are in order of worst to best values
+        of fitness.
+        '''
+        order = np.argsort(self._fits)
+        # indices are always in range, mode='clip' lets take write straight into out
+        np.take(self.population, order, axis=0, out=self._sorted_pop, mode='clip')
+        np.take(self._fits, order, out=self._sorted_fits, mode='clip')
+        return self._sorted_pop, self._sorted_fits
 
 
-    def _sort_pop(self, population):
+    def _search(self, cdf, draws):
         '''
-        Takes a list of dictionaries (parameter : value pairs) and returns
-        sorted list by model_fitness. Output list will be in order of
-        worst to best values of fitness.
+        Maps uniform [0, 1) draws onto population indices through a selection CDF.
         '''
-        return sorted(population, key=self._model_fitness)
+        return np.minimum(np.searchsorted(cdf, draws), len(cdf) - 1)
 
 
-    def roulette_select(self, sorted_pop, summation):
+    def roulette_select(self, fits, draws):
         '''
         Selection technique that gives higher probability of selection based on highest fitness.
 
@@ -138,29 +216,30 @@ class GeneticAlgorithm:
             Free from bias
 
         Cons:
-            Risk of premature convergence, requires sorting to scale negative fitness values,
+            Risk of premature convergence, requires scaling negative fitness values,
             depends on variance present in the fitness function
-        '''
-        offset = 0
-
-        lowest_fitness = self._model_fitness(sorted_pop[0])
-        if lowest_fitness < 0:
-            offset = -lowest_fitness
-            summation += offset * len(sorted_pop)
 
-        draw = np.random.uniform(0, 1)
-
-        cumulative = 0
-        for idx, individual in enumerate(sorted_pop, start=1):
-            fitness = self._model_fitness(individual) + offset
-            p = fitness / summation
-            cumulative += p
+        input:
+            fits - fitness of the population (any order)
+            draws - uniform [0, 1) draws, one per individual to select
 
-            if draw <= cumulative:
-                return individual, idx
+        output:
+            array of indices into the population
+        '''
+        # CDF of the population's fitness (shifted so negative fitness
+        # values still get a valid probability)
+        lowest_fitness = fits.min()
+        offset = -lowest_fitness if lowest_fitness < 0 else 0
+        cdf = np.cumsum(fits + offset)
+        if cdf[-1] > 0:
+            cdf /= cdf[-1]
+        else:
+            # no fitness to weigh by, every individual is equally likely
+            cdf = self._uniform_cdf
+        return self._search(cdf, draws)
 
 
-    def rank_select(self, sorted_pop, summation):
+    def rank_select(self, fits, draws):
         '''
         Selection technique that gives higher probability of selection to the highest ranks.
 
@@ -169,55 +248,56 @@ class GeneticAlgorithm:
 
         Cons:
             Sorting required can be computationally expensive
+
+        input:
+            fits - fitness of the population, sorted worst to best
+            draws - uniform [0, 1) draws, one per individual to select
+
+        output:
+            array of indices into the sorted population
         '''
-        cumulative = 0
-        draw = np.random.uniform(0,1)
-        for idx, individual in enumerate(sorted_pop, start=1):
-            p = idx / summation
-            cumulative += p
-            if draw <= cumulative:
-                return individual, idx
+        # the CDF of the ranks only depends on pop_size (built in run)
+        return self._search(self._rank_cdf, draws)
 
-    def _mutation(self, individual, mutation_prob):
+    def _mutation(self, children, mutation_probs, noise):
         '''
-        Generates mutation of indiviudal by adding a random number in [-bound, bound]
-        to each value in the individual's feature set. The bound is determined
-        by taking a percent of the mean of the feature's bounds. In dynamic mutation,
-        this percent is passed in by mutation_prob, and in normal mutation, the percent
+        Generates mutation of each child by adding a random number in [-bound, bound]
+        to each value in the child's feature set. The bound is determined
+        by taking a percent of the feature's value. In dynamic mutation,
+        this percent is given per child by mutation_probs, and in normal mutation, the percent
         is given by the set mutation_rate.
 
         input:
-            individual - a dictionary with a feature set {parameter : value}
+            children - 2D array, one feature set per row (mutated in place)
+            mutation_probs - 1D array of per-child mutation rates (ignored unless dynamic)
+            noise - uniform [-1, 1) draws, same shape as children
         output:
-            returns a dictionary with mutated values
+            returns the mutated children, clipped to the boundaries
         '''
-        x = 0
-        for k in individual.keys():
-            if self.dynamic:
-                bound = mutation_prob*individual[k]
-            else:
-                bound = self.mutation_rate*individual[k]
-            itr =  individual[k] + np.random.uniform(-bound, bound)
-            individual[k] = min( max(itr, self.boundaries[x][0]), self.boundaries[x][1] )
-            x += 1
-        return individual
+        bounds = self._scratch[:len(children)]
+        if self.dynamic:
+            np.multiply(mutation_probs[:, None], children, out=bounds)
+        else:
+            np.multiply(self.mutation_rate, children, out=bounds)
+        bounds *= noise
+        children += bounds
+        return np.clip(children, self._lows, self._highs, out=children)
 
 
-    def _crossover(self, a, b):
+    def _crossover(self, a, b, out=None):
         '''
-        Crossover function takes two given individuals and
-        returns a dictionary of {paramter : value} pairs based on averages.
+        Crossover function takes two given individuals (or two equally sized
+        blocks of individuals, paired by row) and returns their element-wise average.
 
         input:
-            a, b - two individuals to crossover (dictionaries with a feature
-            set {parameter : value})
+            a, b - individuals to crossover (1D feature set arrays or 2D blocks)
+            out - optional array to write the result into (may be a)
 
         output:
-            returns a single individual crossed between the input individuals
+            returns the individual(s) crossed between the inputs
         '''
-        cross = {}
-        for (k,v), (_,v2) in zip(a.items(), b.items()):
-            cross[k] = np.mean([v, v2])
+        cross = np.add(a, b, out=out)
+        cross *= 0.5
         return cross
 
 
@@ -225,39 +305,47 @@ class GeneticAlgorithm:
         '''
         Generates a new population using selection, crossover, and mutation techniques.
         '''
-        mpool = []
-        sorted_pop = self._sort_pop(self.population)
-
-        if self.select == self.roulette_select:
-            # roulette selection, sum of the population's total fitness
-            summation = sum(self._model_fitness(individual) for individual in self.population)
-        elif self.select == self.rank_select:
-            # rank selection - sum of the ranks
-            summation = sum(range(1, self.pop_size+1))
+        pop, fits = self.population, self._fits
+        if self.select == self.rank_select or self.dynamic:
+            # ranks are only needed for rank selection and dynamic mutation,
+            # roulette alone works on the population in any order
+            pop, fits = self._sort_pop()
 
-        for _ in range(self.pop_size - self.top):
-            x1, r1 = self.select(sorted_pop, summation)
-            x2, r2 = self.select(sorted_pop, summation)
+        # Keeps the highest performing individuals from the previous pool, makes sure
+        # we don't skip past the best individual (allows for higher exploration rates)
+        elite = np.argpartition(fits, -self.top)[-self.top:] if self.top else np.empty(0, dtype=np.intp)
+        self._elite_fits = fits[elite]
+
+        # all random numbers for the generation in two calls, written into the preallocated buffers
+        n_children = self.pop_size - self.top
+        sel_draws = self._rng.random(out=self._draws[:2*n_children])
+        mut_noise = self._rng.random(out=self._noise[:n_children])
+        mut_noise *= 2
+        mut_noise -= 1
+
+        # both parents of every child
+        parents = self.select(fits, sel_draws).reshape(-1, 2)
+
+        # next generation is written into the spare buffer (see run)
+        mpool = self._next_pop
+        children = mpool[:n_children]
+        # mode='clip' (indices are in range) so take writes straight into the buffers
+        np.take(pop, parents[:, 0], axis=0, out=children, mode='clip')
+        second = np.take(pop, parents[:, 1], axis=0, out=self._scratch[:n_children], mode='clip')
+        self._crossover(children, second, out=children)
 
+        if self.dynamic:
             # Used for dynamic shrinking of mutation rate
             # Inverts the ranking (rk 30 --> rk 1 since feature sets with
             # better fitness have higher index)
-            r1 = self.pop_size - r1 + 1
-            r2 = self.pop_size - r2 + 1
-
-            if self.dynamic:
-                # Gives a smaller % of noise to higher ranked individuals
-                mutation_prob = self.mutation_rate*(np.mean([r1,r2]) / self.pop_size)
-            else:
-                mutation_prob = None
-
-            x_new = self._crossover(x1, x2)
-            mpool.append(self._mutation(x_new, mutation_prob))
+            ranks = self.pop_size - parents
+            # Gives a smaller % of noise to higher ranked individuals
+            mutation_probs = self.mutation_rate*(ranks.mean(axis=1) / self.pop_size)
+        else:
+            mutation_probs = None
+        self._mutation(children, mutation_probs, mut_noise)
 
-        # Keeps the highest performing individuals from the previous pool, makes sure
-        # we don't skip past the best individual (allows for higher exploration rates)
-        for x in range(1, self.top + 1):
-            mpool.append(sorted_pop[-x])
+        np.take(pop, elite, axis=0, out=mpool[n_children:], mode='clip')
         return mpool
 
 
@@ -284,6 +372,9 @@ class GeneticAlgorithm:
             dictionary feature set of the highest performing individual in the final population
         '''
         self._gen = generations # save for export data
+        # work on a private copy, population is swapped with the internal buffer every
+        # generation and arrays handed out by earlier runs must not be overwritten
+        self.population = self.population.copy()
         self._exp = exploration
 
         # set mutation rate before each run
@@ -302,6 +393,11 @@ class GeneticAlgorithm:
         else:
             raise ValueError(f'{select} invalid : opt [roulette/rank]')
 
+        # selection CDFs that are fixed for the whole run
+        ranks = np.arange(1, self.pop_size+1, dtype=float)
+        self._rank_cdf = np.cumsum(ranks) / ranks.sum()
+        self._uniform_cdf = ranks / self.pop_size
+
         if keep_top > self.pop_size:
             print('keep_top greater than population size, defaulting to standard')
             self.top = 1
@@ -312,23 +408,32 @@ class GeneticAlgorithm:
         if mode != 'maximize' and mode != 'minimize':
             raise ValueError(f'{mode} invalid : opt [maximize/minimize]')
         self.mode = mode
+        # fitness is always maximized, minimization flips the sign of the predictions
+        self._sign = -1.0 if mode == 'minimize' else 1.0
 
         best_hist = []
         # Run through the generations
         if verbose:
             print('Genetic Algorithm Walk\n----------------------')
+        # the first generation of a run is predicted in full (model, scalers or mode may have changed)
+        n_new = self.pop_size
         for x in range(generations):
-            # append prediction to convergence history (lets us analyze converge behavior)
-            best = round(self.model_predict(self._sort_pop(self.population)[-1]),self._precision)
+            # one batched prediction per generation
+            self._update_fitness(n_new)
+            # append prediction to convergence history (lets us analyze converge behavior),
+            # undoing the sign flip gives back the model's prediction
+            best = round(self._fits.max() * self._sign, self._precision)
             best_hist.append(best)
-            # generate new mating pool
-            self.population = self._mating_pool()
+            # generate new mating pool, the old population's buffer is reused for the next one
+            self.population, self._next_pop = self._mating_pool(), self.population
+            n_new = self.pop_size - self.top
             if verbose:
                 print(f'\nGENERATION {x+1}')
                 for indiviudal in self.population:
-                    print(indiviudal)
-        # The last item in the sorted population is the highest performer
-        best = self._sort_pop(self.population)[-1]
+                    print(self._to_dict(indiviudal))
+        # The individual with the highest fitness is the highest performer
+        self._update_fitness(n_new)
+        best = self._to_dict(self.population[np.argmax(self._fits)])
         return best, best_hist
 
 
@@ -343,32 +448,30 @@ class GeneticAlgorithm:
 
         if best==None:
             best, _ = self.run()
-        # open output file for writing
-        out_path = os.path.join(os.path.dirname(__file__), 'report/optimize_parameters.txt')
-
-        if os.path.exists(out_path):
-            out = open(out_path, 'a')
-        else:
-            report_dir = os.path.exists(os.path.join(os.path.dirname(__file__), 'report'))
-            if not report_dir:
-                os.makedirs(report_dir)
-            out = open(out_path, 'w')
-            out.write('================================================='
-                      '\n             Optimal Paramter Report'
-                      '\n================================================='
-                      '\nReport with all GA runs. Shows the model, the'
-                      '\nGA run outputs, and which GA settings were used.\n')
+        report_dir = os.path.join(os.path.dirname(__file__), 'report')
+        os.makedirs(report_dir, exist_ok=True)
+        out_path = os.path.join(report_dir, 'optimize_parameters.txt')
+
+        # build the whole entry first and write it in one call
+        parts = []
+        if not os.path.exists(out_path):
+            parts.append('================================================='
+                         '\n             Optimal Paramter Report'
+                         '\n================================================='
+                         '\nReport with all GA runs. Shows the model, the'
+                         '\nGA run outputs, and which GA settings were used.\n')
 
         if self.dynamic:
             mr = f'dynamic >> exploration rate: {self._exp}'
         else:
             mr = str(self.mutation_rate)
 
-        print('\n=======================================')
-        print(f'{type(self.model).__name__} Model\n---------------------------------------')
-        out.write(
+        model_name = type(self.model if self.batch_model is None else self.batch_model).__name__
+        prediction = self.model_predict(best)
+
+        parts.append(
             '\n================================================='
-            f'\n{type(self.model).__name__} Model\n-------------------------------------------------'
+            f'\n{model_name} Model\n-------------------------------------------------'
             f'\nGA Parameters\n-------------'
             f'\nPopulation Size: {self.pop_size}'
             f'\nGenerations: {self._gen}'
@@ -377,17 +480,19 @@ class GeneticAlgorithm:
             f'\nKeep Top: {self.top}'
             f'\n-------------------------------------------------\nFeatures\n--------\n'
             )
-        for k, v in best.items():
-            print(f'{k}: {v}')
-            out.write(f'{k}: {v}\n')
-
-        out.write(f'-------------------------------------------------'
+        features = ''.join(f'{k}: {v}\n' for k, v in best.items())
+        parts.append(features)
+        parts.append(f'-------------------------------------------------'
             f'\nPrediction\n----------'
-            f'\n{self.model_predict(best)}'
+            f'\n{prediction}'
             '\n=================================================\n'
             )
-        print('---------------------------------------\nPrediction:', round(self.model_predict(best), self._precision))
-        print('=======================================')
 
-        out.close()
-    
+        with open(out_path, 'a') as out:
+            out.write(''.join(parts))
+
+        print('\n=======================================')
+        print(f'{model_name} Model\n---------------------------------------')
+        print(features, end='')
+        print('---------------------------------------\nPrediction:', round(prediction, self._precision))
+        print('=======================================')